@@ -1,89 +1,158 @@
 import os
 import socket
-from typing import Tuple
-from http_utils import http_date_now, parse_request_line, safe_path, split_headers_body, guess_mime
+import threading
+from typing import BinaryIO, List, Optional, Tuple
+from http_utils import http_date_bytes, parse_request_line, safe_path, guess_mime
 
 TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), "templates", "dir_listing.html")
 HOST = "0.0.0.0"
 PORT = 8080
 SERVER_NAME = "DaygerHTTP/2.0"
+RECV_SIZE = 32 * 1024
+
+def _load_template() -> List[List[bytes]]:
+    # The listing template is read once and pre-split around its placeholders,
+    # so rendering is a join of byte fragments instead of str.replace() passes.
+    with open(TEMPLATE_PATH, "rb") as tf:
+        return [part.split(b"{{path}}") for part in tf.read().split(b"{{items}}")]
+
+TEMPLATE_PARTS = _load_template()
+
+STATUS_LINES = {
+    (code, reason): f"HTTP/1.0 {code} {reason}\r\n".encode()
+    for code, reason in [
+        (200, "OK"),
+        (400, "Bad Request"),
+        (404, "Not Found"),
+        (405, "Method Not Allowed"),
+    ]
+}
+SERVER_LINE = f"\r\nServer: {SERVER_NAME}\r\n".encode()
+HEADER_TAIL = b"\r\nConnection: close\r\n\r\n"
+
+def respond_headers(status_code: int, reason: str, length: int, mime: bytes = b"text/html; charset=utf-8") -> bytes:
+    status = STATUS_LINES.get((status_code, reason))
+    if status is None:
+        status = f"HTTP/1.0 {status_code} {reason}\r\n".encode()
+    return b"".join((
+        status,
+        b"Date: ", http_date_bytes(),
+        SERVER_LINE,
+        b"Content-Type: ", mime,
+        b"\r\nContent-Length: %d" % length,
+        HEADER_TAIL,
+    ))
+
+def respond(status_code: int, reason: str, body: bytes, mime: bytes = b"text/html; charset=utf-8") -> bytes:
+    return respond_headers(status_code, reason, len(body), mime) + body
+
+def render_error(code: int, msg: str) -> bytes:
+    body = f"<html><body><h1>{code} {msg}</h1></body></html>".encode()
+    return respond(code, msg, body)
 
-def respond(status_code: int, reason: str, body: bytes, mime: str = "text/html; charset=utf-8") -> bytes:
-    return (
-        f"HTTP/1.0 {status_code} {reason}\r\n"
-        f"Date: {http_date_now()}\r\n"
-        f"Server: {SERVER_NAME}\r\n"
-        f"Content-Type: {mime}\r\n"
-        f"Content-Length: {len(body)}\r\n"
-        "Connection: close\r\n\r\n"
-    ).encode() + body
+def split_at_date(resp: bytes) -> Tuple[bytes, bytes]:
+    start = resp.index(b"Date: ") + len(b"Date: ")
+    return resp[:start], resp[resp.index(b"\r\n", start):]
+
+# Error responses only differ in their Date header, so each one is
+# serialized once and split around the date value.
+ERROR_PAGES = {
+    (code, reason): split_at_date(render_error(code, reason))
+    for code, reason in STATUS_LINES
+    if code >= 400
+}
 
 def respond_text(code: int, msg: str) -> bytes:
-    body = f"<html><body><h1>{code} {msg}</h1></body></html>".encode()
-    return respond(code, msg, body)
+    page = ERROR_PAGES.get((code, msg))
+    if page is None:
+        return render_error(code, msg)
+    return page[0] + http_date_bytes() + page[1]
 
 def directory_listing_html(req_path: str, fs_dir: str, root: str) -> bytes:
     try:
-        items = sorted(os.listdir(fs_dir))
+        with os.scandir(fs_dir) as it:
+            entries = sorted(it, key=lambda e: e.name)
     except OSError:
         return respond_text(404, "Not Found")
 
     if not req_path.endswith("/"):
         req_path += "/"
 
-    with open(TEMPLATE_PATH, "r", encoding="utf-8") as f:
-        template = f.read()
-
+    prefix = req_path.encode()
     list_items = []
 
-    if os.path.realpath(fs_dir) != os.path.realpath(root):
+    if fs_dir != root:
         parts = req_path.rstrip("/").split("/")
         parent = "/".join(parts[:-1])
         if not parent:
             parent = "/"
         elif not parent.endswith("/"):
             parent += "/"
-        list_items.append(f'<li class="dir"><a href="{parent}">..</a></li>')
-
-    for name in items:
-        href = req_path + name
-        full = os.path.join(fs_dir, name)
-        if os.path.isdir(full):
-            href += "/"
-            list_items.append(f'<li class="dir"><a href="{href}">{name}/</a></li>')
+        list_items.append(b'<li class="dir"><a href="%s">..</a></li>' % parent.encode())
+
+    # DirEntry.is_dir() answers from the directory read itself, so entries
+    # cost no extra stat() unless they are symlinks.
+    for entry in entries:
+        name = entry.name.encode()
+        if entry.is_dir():
+            list_items.append(b'<li class="dir"><a href="%s%s/">%s/</a></li>' % (prefix, name, name))
         else:
-            list_items.append(f'<li class="file"><a href="{href}">{name}</a></li>')
+            list_items.append(b'<li class="file"><a href="%s%s">%s</a></li>' % (prefix, name, name))
 
-    body_html = template.replace("{{path}}", req_path).replace("{{items}}", "\n".join(list_items))
-    return respond(200, "OK", body_html.encode("utf-8"), mime="text/html; charset=utf-8")
+    body_html = b"\n".join(list_items).join(prefix.join(part) for part in TEMPLATE_PARTS)
+    return respond(200, "OK", body_html, mime=b"text/html; charset=utf-8")
 
-def serve_file(fs_path: str) -> bytes:
+def serve_file(fs_path: str) -> Tuple[bytes, Optional[BinaryIO], int]:
+    # Only the header block is built here; the caller streams the body
+    # straight from the returned file with sendfile().
     mime = guess_mime(fs_path)
     try:
-        with open(fs_path, "rb") as f:
-            data = f.read()
+        f = open(fs_path, "rb")
     except OSError:
-        return respond_text(404, "Not Found")
-    return respond(200, "OK", data, mime)
+        return respond_text(404, "Not Found"), None, 0
+    size = os.fstat(f.fileno()).st_size
+    return respond_headers(200, "OK", size, mime), f, size
+
+recv_local = threading.local()
+
+def recv_buffer() -> memoryview:
+    # Each thread receives into one preallocated buffer that is reused for
+    # every request it handles, instead of growing a new one per request.
+    view = getattr(recv_local, "view", None)
+    if view is None:
+        view = recv_local.view = memoryview(bytearray(RECV_SIZE))
+    return view
+
+def set_cork(conn: socket.socket, on: bool):
+    # TCP_CORK is Linux-only; elsewhere headers and body go out as written.
+    if hasattr(socket, "TCP_CORK"):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(on))
 
 def handle(conn: socket.socket, root: str):
     try:
         conn.settimeout(5)
-        data = b""
-        while b"\r\n\r\n" not in data:
-            chunk = conn.recv(4096)
-            if not chunk:
+        view = recv_buffer()
+        buf = view.obj
+        filled = 0
+        end = -1
+        # A head larger than the buffer is parsed from what fits; only the
+        # request line is needed.
+        while filled < RECV_SIZE:
+            n = conn.recv_into(view[filled:])
+            if not n:
+                break
+            # Only the new bytes (plus 3 for a separator split across
+            # chunks) need scanning.
+            end = buf.find(b"\r\n\r\n", max(0, filled - 3), filled + n)
+            filled += n
+            if end != -1:
                 break
-            data += chunk
-
-        headers, _ = split_headers_body(data)
-        lines = headers.split(b"\r\n")
-        if not lines:
-            conn.sendall(respond_text(400, "Bad Request"))
-            return
 
-        req_line = lines[0].decode(errors="replace")
-        method, target, version = parse_request_line(req_line)
+        # Only the request line is used, so the rest of the head is never
+        # copied or split into lines.
+        head_end = end if end != -1 else filled
+        line_end = buf.find(b"\r\n", 0, head_end)
+        method, target, version = parse_request_line(view[:head_end if line_end == -1 else line_end].tobytes())
         if not method or not target:
             conn.sendall(respond_text(400, "Bad Request"))
             return
@@ -97,11 +166,21 @@ def handle(conn: socket.socket, root: str):
             return
 
         if is_dir:
-            resp = directory_listing_html(target, fs_path, root)
-        else:
-            resp = serve_file(fs_path)
+            conn.sendall(directory_listing_html(target, fs_path, root))
+            return
 
-        conn.sendall(resp)
+        headers, f, _ = serve_file(fs_path)
+        if not f:
+            conn.sendall(headers)
+            return
+
+        # Corked, the headers are held back and leave in the same segment
+        # as the start of the file body.
+        set_cork(conn, True)
+        with f:
+            conn.sendall(headers)
+            conn.sendfile(f)
+        set_cork(conn, False)
     finally:
         try:
             conn.shutdown(socket.SHUT_RDWR)
@@ -109,25 +188,61 @@ def handle(conn: socket.socket, root: str):
             pass
         conn.close()
 
+def make_listener(port: int, sock_buf: int = 0) -> socket.socket:
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    # Setting SO_SNDBUF/SO_RCVBUF turns off Linux buffer autotuning for
+    # every accepted socket, and the kernel clamps the value to
+    # net.core.[rw]mem_max (about 208 KiB on stock hosts, doubled). So the
+    # kernel's sizing is kept unless --sock-buf asks for a fixed size on a
+    # host tuned for it. Accepted connections inherit the listener's sizes.
+    if sock_buf:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sock_buf)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, sock_buf)
+    s.bind((HOST, port))
+    s.listen(5)
+    return s
+
+def accept_loop(s: socket.socket, root: str):
+    with s:
+        while True:
+            conn, addr = s.accept()
+            print(f"Connection from {addr}")
+            # One bad connection (e.g. a client that never sends and hits
+            # the recv timeout) must not take this listener down with it.
+            try:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                handle(conn, root)
+            except Exception as e:
+                print("Error:", e)
+
 # ---------- SERVER LOOP ----------
 def main():
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("directory", help="Directory to serve")
     parser.add_argument("--port", type=int, default=PORT)
+    # The default stays at one accept loop so Lab 1 remains the sequential
+    # baseline that Lab 2's README benchmarks against.
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Accept loops, each with its own SO_REUSEPORT listener (default: 1)")
+    parser.add_argument("--sock-buf", type=int, default=0,
+                        help="Fixed SO_SNDBUF/SO_RCVBUF size in bytes (default: kernel autotuning)")
     args = parser.parse_args()
 
-    root = os.path.abspath(args.directory)
+    root = os.path.realpath(args.directory)
     print(f"Serving '{root}' on http://0.0.0.0:{args.port}")
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((HOST, args.port))
-        s.listen(5)
-        while True:
-            conn, addr = s.accept()
-            print(f"Connection from {addr}")
-            handle(conn, root)
+    # With SO_REUSEPORT the kernel spreads new connections across the
+    # listeners, so no single accept queue is shared between threads.
+    # Without it only one listener can bind the port.
+    workers = max(1, args.workers) if hasattr(socket, "SO_REUSEPORT") else 1
+    socks = [make_listener(args.port, args.sock_buf) for _ in range(workers)]
+    for s in socks[1:]:
+        threading.Thread(target=accept_loop, args=(s, root), daemon=True).start()
+    accept_loop(socks[0], root)
 
 if __name__ == "__main__":
     main()
@@ -1,61 +1,109 @@
 import email.utils
 import os
+import stat
+import time
 import urllib.parse
+from functools import lru_cache
 from typing import Tuple, Optional
 
+# Values are pre-encoded so they drop straight into the response header.
 ALLOWED_MIME = {
-    ".html": "text/html; charset=utf-8",
-    ".htm":  "text/html; charset=utf-8",
-    ".css":  "text/css; charset=utf-8",
-    ".js":   "application/javascript; charset=utf-8",
-    ".png":  "image/png",
-    ".jpg":  "image/jpeg",
-    ".jpeg": "image/jpeg",
-    ".gif":  "image/gif",
-    ".svg":  "image/svg+xml",
-    ".ico":  "image/x-icon",
-    ".pdf":  "application/pdf",
-    ".txt":  "text/plain; charset=utf-8",
-    ".json": "application/json; charset=utf-8",
-    ".xml":  "application/xml; charset=utf-8",
-    ".mp4":  "video/mp4",
-    ".webm": "video/webm",
-    ".mp3":  "audio/mpeg",
-    ".wav":  "audio/wav",
-    ".ogg":  "audio/ogg",
+    ".html": b"text/html; charset=utf-8",
+    ".htm":  b"text/html; charset=utf-8",
+    ".css":  b"text/css; charset=utf-8",
+    ".js":   b"application/javascript; charset=utf-8",
+    ".png":  b"image/png",
+    ".jpg":  b"image/jpeg",
+    ".jpeg": b"image/jpeg",
+    ".gif":  b"image/gif",
+    ".svg":  b"image/svg+xml",
+    ".ico":  b"image/x-icon",
+    ".pdf":  b"application/pdf",
+    ".txt":  b"text/plain; charset=utf-8",
+    ".json": b"application/json; charset=utf-8",
+    ".xml":  b"application/xml; charset=utf-8",
+    ".mp4":  b"video/mp4",
+    ".webm": b"video/webm",
+    ".mp3":  b"audio/mpeg",
+    ".wav":  b"audio/wav",
+    ".ogg":  b"audio/ogg",
 }
 
-def http_date_now() -> str:
-    return email.utils.formatdate(usegmt=True)
+_date_cache: Tuple[int, bytes] = (0, b"")
 
-def split_headers_body(raw: bytes) -> Tuple[bytes, bytes]:
-    sep = b"\r\n\r\n"
-    idx = raw.find(sep)
-    return (raw[:idx], raw[idx+4:]) if idx != -1 else (raw, b"")
+def http_date_bytes() -> bytes:
+    # formatdate() is slow and its output only changes once per second.
+    global _date_cache
+    now = int(time.time())
+    if _date_cache[0] != now:
+        _date_cache = (now, email.utils.formatdate(now, usegmt=True).encode())
+    return _date_cache[1]
 
-def parse_request_line(line: str):
-    parts = line.strip().split()
+def parse_request_line(line: bytes) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    # Split the raw bytes and decode only the three tokens; bytes.split()
+    # with no separator already drops surrounding whitespace.
+    parts = line.split()
     if len(parts) != 3:
         return None, None, None
     method, target, version = parts
-    return method, target, version
+    return method.decode("latin-1"), target.decode(errors="replace"), version.decode("latin-1")
+
+def _origin_path(target: str) -> str:
+    # The path is everything before the first "?" or "#"; for an
+    # absolute-form target ("http://host/path") the scheme and authority
+    # are skipped as well. No generic URL parsing is needed.
+    end = len(target)
+    q = target.find("?")
+    if q != -1:
+        end = q
+    h = target.find("#", 0, end)
+    if h != -1:
+        end = h
+    start = 0
+    if not target.startswith("/"):
+        sep = target.find("://", 0, end)
+        if sep != -1:
+            slash = target.find("/", sep + 3, end)
+            start = slash if slash != -1 else end
+    return target[start:end]
+
+@lru_cache(maxsize=1)
+def _root_real(root: str) -> str:
+    return os.path.realpath(root)
+
+def _relative_path(url_path: str) -> str:
+    path = _origin_path(url_path)
+    if "%" in path:
+        path = urllib.parse.unquote(path)
+    return path.lstrip("/")
 
 def safe_path(root: str, url_path: Optional[str]) -> Tuple[str, bool]:
     if not url_path:
         return "", False
 
-    path = urllib.parse.urlsplit(url_path).path
-    path = urllib.parse.unquote(path)
-
-    joined = os.path.normpath(os.path.join(root, path.lstrip("/")))
-    root_real = os.path.realpath(root)
+    joined = os.path.normpath(os.path.join(root, _relative_path(url_path)))
+    root_real = _root_real(root)
     joined_real = os.path.realpath(joined)
 
     if not joined_real.startswith(root_real):
         return "", False
 
-    return joined_real, os.path.isdir(joined_real)
+    try:
+        is_dir = stat.S_ISDIR(os.stat(joined_real).st_mode)
+    except OSError:
+        is_dir = False
+    return joined_real, is_dir
+
+_MAX_EXT = max(map(len, ALLOWED_MIME))
+
+@lru_cache(maxsize=64)
+def _mime_for_ext(ext: str) -> bytes:
+    return ALLOWED_MIME.get(ext.lower(), b"application/octet-stream")
 
-def guess_mime(path: str) -> str:
-    ext = os.path.splitext(path)[1].lower()
-    return ALLOWED_MIME.get(ext, "application/octet-stream")
+def guess_mime(path: str) -> bytes:
+    # The cache is keyed on the short extension rather than the full path,
+    # so arbitrary (e.g. 404) paths cannot grow it.
+    ext = os.path.splitext(path)[1]
+    if len(ext) > _MAX_EXT:
+        return b"application/octet-stream"
+    return _mime_for_ext(ext)
@@ -1,38 +1,103 @@
+import asyncio
 import os
+import select
 import socket
 import threading
 import time
-from collections import defaultdict, deque
-from http_utils import http_date_now, parse_request_line, safe_path, split_headers_body, guess_mime
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, List, Optional, Tuple
+from http_utils import http_date_bytes, parse_request_line, safe_path, guess_mime
 
 TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), "templates", "dir_listing.html")
 HOST = "0.0.0.0"
 PORT = 8080
 SERVER_NAME = "ServerHTTP/2.0"
+SEND_TIMEOUT = 5
 
-request_counts = defaultdict(int)
-counter_lock = threading.Lock()
+# File responses are written from these threads so that a slow open() or a
+# cold-cache sendfile() never stalls the event loop.
+FILE_POOL = ThreadPoolExecutor(max_workers=32)
+
+def _load_template() -> List[List[bytes]]:
+    # The listing template is read once and pre-split around its placeholders,
+    # so rendering is a join of byte fragments instead of str.replace() passes.
+    with open(TEMPLATE_PATH, "rb") as tf:
+        return [part.split(b"{{path}}") for part in tf.read().split(b"{{items}}")]
+
+
+TEMPLATE_PARTS = _load_template()
+
+# Each worker thread runs its own event loop, so the shared dicts below are
+# guarded by striped locks: requests for different keys rarely contend.
+# A Counter also lets the directory listing read missing paths as 0
+# without inserting them.
+request_counts = Counter()
+counter_locks = [threading.Lock() for _ in range(16)]
 
-rate_limit = defaultdict(lambda: deque(maxlen=5))
-rate_lock = threading.Lock()
 RATE = 5
 WINDOW = 1.0
+rate_limit = defaultdict(lambda: deque(maxlen=RATE))
+rate_locks = [threading.Lock() for _ in range(32)]
+
+
+STATUS_LINES = {
+    (code, reason): f"HTTP/1.0 {code} {reason}\r\n".encode()
+    for code, reason in [
+        (200, "OK"),
+        (400, "Bad Request"),
+        (404, "Not Found"),
+        (405, "Method Not Allowed"),
+        (429, "Too Many Requests"),
+        (500, "Internal Server Error"),
+    ]
+}
+SERVER_LINE = f"\r\nServer: {SERVER_NAME}\r\n".encode()
+HEADER_TAIL = b"\r\nConnection: close\r\n\r\n"
+
+
+def respond_headers(status_code: int, reason: str, length: int, mime: bytes = b"text/html; charset=utf-8") -> bytes:
+    status = STATUS_LINES.get((status_code, reason))
+    if status is None:
+        status = f"HTTP/1.0 {status_code} {reason}\r\n".encode()
+    return b"".join((
+        status,
+        b"Date: ", http_date_bytes(),
+        SERVER_LINE,
+        b"Content-Type: ", mime,
+        b"\r\nContent-Length: %d" % length,
+        HEADER_TAIL,
+    ))
+
+
+def respond(status_code: int, reason: str, body: bytes, mime: bytes = b"text/html; charset=utf-8") -> bytes:
+    return respond_headers(status_code, reason, len(body), mime) + body
+
+
+def render_error(code: int, msg: str) -> bytes:
+    body = f"<html><body><h1>{code} {msg}</h1></body></html>".encode()
+    return respond(code, msg, body)
+
 
+def split_at_date(resp: bytes) -> Tuple[bytes, bytes]:
+    start = resp.index(b"Date: ") + len(b"Date: ")
+    return resp[:start], resp[resp.index(b"\r\n", start):]
 
-def respond(status_code: int, reason: str, body: bytes, mime: str = "text/html; charset=utf-8") -> bytes:
-    return (
-        f"HTTP/1.0 {status_code} {reason}\r\n"
-        f"Date: {http_date_now()}\r\n"
-        f"Server: {SERVER_NAME}\r\n"
-        f"Content-Type: {mime}\r\n"
-        f"Content-Length: {len(body)}\r\n"
-        "Connection: close\r\n\r\n"
-    ).encode() + body
+
+# Error responses only differ in their Date header, so each one is
+# serialized once and split around the date value.
+ERROR_PAGES = {
+    (code, reason): split_at_date(render_error(code, reason))
+    for code, reason in STATUS_LINES
+    if code >= 400
+}
 
 
 def respond_text(code: int, msg: str) -> bytes:
-    body = f"<html><body><h1>{code} {msg}</h1></body></html>".encode()
-    return respond(code, msg, body)
+    page = ERROR_PAGES.get((code, msg))
+    if page is None:
+        return render_error(code, msg)
+    return page[0] + http_date_bytes() + page[1]
 
 def normalize_path(target: str, is_dir: bool) -> str:
     if not target.startswith("/"):
@@ -44,25 +109,25 @@ def normalize_path(target: str, is_dir: bool) -> str:
     return target
 
 
-def increment_request_count(target: str,is_dir: bool, safe=True):
+async def increment_request_count(target: str,is_dir: bool, safe=True):
     key = normalize_path(target, is_dir)
 
     if safe:
-        with counter_lock:
-            request_counts[target] += 1
+        with counter_locks[hash(key) & 15]:
+            request_counts[key] += 1
     else:
-        c = request_counts[target]
-        time.sleep(0.01)
-        request_counts[target] = c + 1
+        c = request_counts[key]
+        await asyncio.sleep(0.01)
+        request_counts[key] = c + 1
 
 
 def is_rate_limited(ip: str) -> bool:
-    now = time.time()
-    with rate_lock:
+    # The deque keeps the last RATE accepted timestamps; the client is over
+    # the limit exactly when the oldest of them is still inside the window.
+    now = time.monotonic()
+    with rate_locks[hash(ip) & 31]:
         q = rate_limit[ip]
-        while q and now - q[0] > WINDOW:
-            q.popleft()
-        if len(q) >= RATE:
+        if len(q) == RATE and now - q[0] <= WINDOW:
             return True
         q.append(now)
         return False
@@ -70,104 +135,209 @@ def is_rate_limited(ip: str) -> bool:
 
 def directory_listing_html(req_path: str, fs_dir: str, root: str) -> bytes:
     try:
-        items = sorted(os.listdir(fs_dir))
+        with os.scandir(fs_dir) as it:
+            entries = sorted(it, key=lambda e: e.name)
     except OSError:
         return respond_text(404, "Not Found")
 
     if not req_path.endswith("/"):
         req_path += "/"
 
-    with open(TEMPLATE_PATH, "r", encoding="utf-8") as f:
-        template = f.read()
-
+    prefix = req_path.encode()
     list_items = []
 
-    if os.path.realpath(fs_dir) != os.path.realpath(root):
+    if fs_dir != root:
         parts = req_path.rstrip("/").split("/")
         parent = "/".join(parts[:-1])
         if not parent:
             parent = "/"
         elif not parent.endswith("/"):
             parent += "/"
-        list_items.append(f'<li class="dir"><a href="{parent}">..</a></li>')
-
-    for name in items:
-        href = req_path + name
-        full = os.path.join(fs_dir, name)
-        if os.path.isdir(full):
-            href += "/"
-        count = request_counts[href]
-        if os.path.isdir(full):
-            list_items.append(f'<li class="dir"><a href="{href}">{name}/</a> ({count})</li>')
+        list_items.append(b'<li class="dir"><a href="%s">..</a></li>' % parent.encode())
+
+    # DirEntry.is_dir() answers from the directory read itself, so entries
+    # cost no extra stat() unless they are symlinks.
+    for entry in entries:
+        name = entry.name.encode()
+        if entry.is_dir():
+            count = request_counts[req_path + entry.name + "/"]
+            list_items.append(b'<li class="dir"><a href="%s%s/">%s/</a> (%d)</li>' % (prefix, name, name, count))
         else:
-            list_items.append(f'<li class="file"><a href="{href}">{name}</a> ({count})</li>')
+            count = request_counts[req_path + entry.name]
+            list_items.append(b'<li class="file"><a href="%s%s">%s</a> (%d)</li>' % (prefix, name, name, count))
 
-    body_html = template.replace("{{path}}", req_path).replace("{{items}}", "\n".join(list_items))
-    return respond(200, "OK", body_html.encode("utf-8"))
+    body_html = b"\n".join(list_items).join(prefix.join(part) for part in TEMPLATE_PARTS)
+    return respond(200, "OK", body_html)
 
 
-def serve_file(fs_path: str) -> bytes:
+def serve_file(fs_path: str) -> Tuple[bytes, Optional[BinaryIO], int]:
+    # Only the header block is built here; the caller streams the body
+    # straight from the returned file with sendfile().
     mime = guess_mime(fs_path)
     try:
-        with open(fs_path, "rb") as f:
-            data = f.read()
+        f = open(fs_path, "rb")
     except OSError:
-        return respond_text(404, "Not Found")
-    return respond(200, "OK", data, mime)
+        return respond_text(404, "Not Found"), None, 0
+    size = os.fstat(f.fileno()).st_size
+    return respond_headers(200, "OK", size, mime), f, size
+
+
+def wait_writable(fd: int):
+    poller = select.poll()
+    poller.register(fd, select.POLLOUT)
+    if not poller.poll(SEND_TIMEOUT * 1000):
+        raise TimeoutError("timed out waiting to send")
+
+
+def send_file_blocking(fd: int, fs_path: str):
+    # Runs on FILE_POOL while the handler awaits it, so nothing else writes
+    # to the socket meanwhile. fd is a dup() owned by this call: if the loop
+    # closes its own descriptor after a reset, writes here fail instead of
+    # landing on whatever connection reuses that number. The socket stays
+    # non-blocking because the event loop shares it, hence the explicit
+    # wait on EAGAIN.
+    with socket.socket(fileno=fd) as conn:
+        headers, f, size = serve_file(fs_path)
+        if not f:
+            write_all(fd, headers)
+            return
 
+        # Corked, the headers are held back and leave in the same segment
+        # as the start of the file body.
+        set_cork(conn, True)
+        with f:
+            write_all(fd, headers)
+            offset = 0
+            while offset < size:
+                try:
+                    sent = os.sendfile(fd, f.fileno(), offset, size - offset)
+                except BlockingIOError:
+                    wait_writable(fd)
+                    continue
+                if sent == 0:
+                    break
+                offset += sent
+        set_cork(conn, False)
+
+
+def write_all(fd: int, data: bytes):
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[os.write(fd, view):]
+        except BlockingIOError:
+            wait_writable(fd)
 
-def handle(conn: socket.socket, root: str):
+
+def set_cork(sock, on: bool):
+    # TCP_CORK is Linux-only; elsewhere headers and body go out as written.
+    if hasattr(socket, "TCP_CORK"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(on))
+
+
+async def send(writer: asyncio.StreamWriter, data: bytes):
+    writer.write(data)
+    await writer.drain()
+
+
+async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, root: str, delay: float = 0.0):
+    print(f"Connection from {writer.get_extra_info('peername')}")
     try:
-        conn.settimeout(5)
-        data = b""
-        while b"\r\n\r\n" not in data:
-            chunk = conn.recv(4096)
-            if not chunk:
-                break
-            data += chunk
-
-        headers, _ = split_headers_body(data)
-        lines = headers.split(b"\r\n")
-        if not lines:
-            conn.sendall(respond_text(400, "Bad Request"))
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+        except asyncio.IncompleteReadError as e:
+            head = e.partial
+        except asyncio.LimitOverrunError:
+            # The head is longer than the StreamReader limit (64 KiB).
+            await send(writer, respond_text(400, "Bad Request"))
             return
-
-        method, target, version = parse_request_line(lines[0].decode(errors="replace"))
+        except asyncio.TimeoutError:
+            # wait_for() raises without a message; keep the old log line.
+            raise TimeoutError("timed out") from None
+
+        # Only the request line is used, so the rest of the head is never
+        # split into lines.
+        line_end = head.find(b"\r\n")
+        method, target, version = parse_request_line(head[:line_end] if line_end != -1 else head)
         if method != "GET":
-            conn.sendall(respond_text(405, "Method Not Allowed"))
+            await send(writer, respond_text(405, "Method Not Allowed"))
             return
 
-        ip = conn.getpeername()[0]
+        ip = writer.get_extra_info("peername")[0]
         if is_rate_limited(ip):
-            conn.sendall(respond_text(429, "Too Many Requests"))
+            await send(writer, respond_text(429, "Too Many Requests"))
             return
 
-        time.sleep(1)  
+        if delay:
+            await asyncio.sleep(delay)
 
         fs_path, is_dir = safe_path(root, target)
         if not fs_path:
-            conn.sendall(respond_text(404, "Not Found"))
+            await send(writer, respond_text(404, "Not Found"))
             return
 
         if is_dir and not target.endswith("/"):
             target += "/"
-        increment_request_count(target,is_dir, safe=True)
+        await increment_request_count(target,is_dir, safe=True)
 
-        resp = directory_listing_html(target, fs_path, root) if is_dir else serve_file(fs_path)
-        conn.sendall(resp)
+        if is_dir:
+            await send(writer, directory_listing_html(target, fs_path, root))
+            return
+
+        fd = os.dup(writer.get_extra_info("socket").fileno())
+        try:
+            future = asyncio.get_running_loop().run_in_executor(FILE_POOL, send_file_blocking, fd, fs_path)
+        except BaseException:
+            os.close(fd)
+            raise
+        await future
 
     except Exception as e:
         print("Error:", e)
         try:
-            conn.sendall(respond_text(500, "Internal Server Error"))
+            await send(writer, respond_text(500, "Internal Server Error"))
         except Exception:
             pass
     finally:
+        writer.close()
         try:
-            conn.shutdown(socket.SHUT_RDWR)
+            await writer.wait_closed()
         except OSError:
             pass
-        conn.close()
+
+
+def make_listener(port: int, sock_buf: int = 0) -> socket.socket:
+    # The listener is built by hand so options such as SO_REUSEPORT and the
+    # buffer sizes are set before listen(). asyncio already turns on
+    # TCP_NODELAY for every connection it accepts.
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    # Setting SO_SNDBUF/SO_RCVBUF turns off Linux buffer autotuning for
+    # every accepted socket, and the kernel clamps the value to
+    # net.core.[rw]mem_max (about 208 KiB on stock hosts, doubled). So the
+    # kernel's sizing is kept unless --sock-buf asks for a fixed size on a
+    # host tuned for it. Accepted connections inherit the listener's sizes.
+    if sock_buf:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sock_buf)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, sock_buf)
+    s.bind((HOST, port))
+    s.listen(10)
+    return s
+
+
+async def serve(root: str, sock: socket.socket, delay: float = 0.0):
+    server = await asyncio.start_server(
+        lambda reader, writer: handle(reader, writer, root, delay),
+        sock=sock,
+    )
+    async with server:
+        await server.serve_forever()
+
+
+def run_worker(root: str, sock: socket.socket, delay: float):
+    asyncio.run(serve(root, sock, delay))
 
 
 def main():
@@ -175,21 +345,29 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("directory", help="Directory to serve")
     parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--artificial-delay", type=float, default=0.0,
+                        help="Seconds to sleep per request to simulate work")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Event loop threads, each with its own SO_REUSEPORT listener")
+    parser.add_argument("--sock-buf", type=int, default=0,
+                        help="Fixed SO_SNDBUF/SO_RCVBUF size in bytes (default: kernel autotuning)")
     args = parser.parse_args()
 
-    root = os.path.abspath(args.directory)
+    root = os.path.realpath(args.directory)
     print(f"Serving '{root}' on http://0.0.0.0:{args.port}")
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((HOST, args.port))
-        s.listen(10)
+    # With SO_REUSEPORT the kernel spreads new connections across the
+    # listeners, so no single accept queue is shared between threads.
+    # Without it only one listener can bind the port.
+    workers = max(1, args.workers) if hasattr(socket, "SO_REUSEPORT") else 1
+    socks = [make_listener(args.port, args.sock_buf) for _ in range(workers)]
+    for sock in socks[1:]:
+        threading.Thread(target=run_worker, args=(root, sock, args.artificial_delay), daemon=True).start()
 
-        while True:
-            conn, addr = s.accept()
-            print(f"Connection from {addr}")
-            t = threading.Thread(target=handle, args=(conn, root), daemon=True)
-            t.start()
+    try:
+        run_worker(root, socks[0], args.artificial_delay)
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
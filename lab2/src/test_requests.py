@@ -1,11 +1,11 @@
+import asyncio
 import sys
-import threading
 import time
 import statistics
 import random
 import os
 from collections import Counter
-import requests
+import aiohttp
 
 
 def usage_and_exit():
@@ -22,19 +22,44 @@ def list_files(base_dir):
     return files
 
 
-def worker(idx, base_url, files, results, timeout=10):
+async def worker(idx, session, base_url, files, results, timeout=10):
     try:
         target = random.choice(files)
         url = f"{base_url.rstrip('/')}/{target}"
-        start = time.time()
-        r = requests.get(url, timeout=timeout)
-        elapsed = time.time() - start
-        results[idx] = (r.status_code, elapsed, None, target)
+        start = time.perf_counter()
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+            await r.read()
+        elapsed = time.perf_counter() - start
+        results[idx] = (r.status, elapsed, None, target)
     except Exception as e:
-        elapsed = time.time() - start if 'start' in locals() else 0.0
+        elapsed = time.perf_counter() - start if 'start' in locals() else 0.0
         results[idx] = (None, elapsed, str(e), None)
 
 
+async def run(total, interval, after_n, extra_delay, base_url, files, results):
+    # One task per request on a shared session; limit=0 lifts aiohttp's
+    # default cap of 100 concurrent connections.
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = []
+        started = 0
+
+        for i in range(total):
+            tasks.append(asyncio.create_task(worker(i, session, base_url, files, results)))
+            started += 1
+
+            if started >= after_n:
+                sleep_time = interval + extra_delay
+            else:
+                sleep_time = interval
+            if i != total - 1:
+                await asyncio.sleep(sleep_time)
+
+        _, pending = await asyncio.wait(tasks, timeout=30)
+        for t in pending:
+            t.cancel()
+
+
 def main():
     if len(sys.argv) < 5:
         print("Usage: python test_requests.py TOTAL INTERVAL AFTER_N CONTENT_DIR [EXTRA_DELAY]")
@@ -63,28 +88,11 @@ def main():
     print(f" - after {after_n} started requests apply extra delay: {extra_delay}s\n")
 
     results = [None] * total
-    threads = []
-    overall_start = time.time()
-    started = 0
-
-    for i in range(total):
-        t = threading.Thread(target=worker, args=(i, base_url, files, results))
-        t.daemon = True
-        t.start()
-        threads.append(t)
-        started += 1
-
-        if started >= after_n:
-            sleep_time = interval + extra_delay
-        else:
-            sleep_time = interval
-        if i != total - 1:
-            time.sleep(sleep_time)
+    overall_start = time.perf_counter()
 
-    for t in threads:
-        t.join(timeout=30)
+    asyncio.run(run(total, interval, after_n, extra_delay, base_url, files, results))
 
-    total_time = time.time() - overall_start
+    total_time = time.perf_counter() - overall_start
 
     # --- ANALYTICS ---
     status_counter = Counter()